@@ -1 +1 @@
-__all__ = ["facedetect"]
\ No newline at end of file
+__all__ = ["facedetect", "engine", "latency", "transport", "store", "cache"]
@@ -0,0 +1,298 @@
+# cache.py
+#
+# Content addressed cache of FaceDetect image results so that repeated images skip the dlib pass
+#
+# Usage:
+#  - Pass a 'result-cache' setting to the FaceDetect constructor: a cache directory or a ResultCache object
+#  - In mode image, the results (face locations, encodings and landmarks) are looked up:
+#   * by the exact hash of the image file
+#   * then by a perceptual hash (dHash) of the decoded pixels to catch near duplicates such as resized copies.
+#     The stored locations and landmarks are rescaled to the size of the queried image
+#  - The cache is bounded in size on disk and evicts the least recently used results
+#  - Hit and miss metrics are exposed through stats()
+#
+# The results are stored in one .npz file per image, loaded without pickle so that a shared cache directory cannot
+# run code. The index of the entries is a SQLite database in the same directory: a hit updates a single row and the
+# eviction reads the least recently used rows through an index.
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import zipfile
+import threading
+import numpy
+from PIL import Image
+
+
+class ResultCache:
+    """ Size bounded LRU disk cache of face detection results keyed by exact and perceptual image hashes """
+
+    VERSION = 3  # Bump to invalidate the stored results when the detection output changes
+    HASH_BANDS = 4  # The 64 bit perceptual hash is indexed in 4 bands of 16 bits
+
+    def __init__(self, directory='.facedetect-cache', max_bytes=256 * 1024 * 1024, perceptual=True, threshold=3):
+        """ Opens (or creates) the cache in the given directory
+        Near duplicates are images whose perceptual hashes differ by at most threshold bits """
+
+        # Any hash within the threshold shares at least one band with the query as long as threshold < bands
+        if perceptual and threshold >= self.HASH_BANDS:
+            raise Exception("The perceptual hash threshold must be lower than %d bits" % self.HASH_BANDS)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.perceptual = perceptual
+        self.threshold = threshold
+
+        # Initialize the metrics
+        self.hits = 0  # Exact hash hits
+        self.near_hits = 0  # Perceptual hash hits
+        self.misses = 0
+
+        # The cache can be shared by FaceDetect instances running in threads
+        self.__lock = threading.RLock()
+
+        # Open the index of the cached entries
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.__band_columns = ['band_%d' % band for band in range(self.HASH_BANDS)]
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    phash INTEGER,
+                    height INTEGER,
+                    width INTEGER,
+                    bytes INTEGER,
+                    used REAL,
+                    %s
+                )
+            """ % ',\n'.join('%s INTEGER' % column for column in self.__band_columns))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            for column in self.__band_columns:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS entries_%s ON entries (%s)' % (column, column))
+
+        # Drop the entries of an older version
+        self.__bytes = 0
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.clear()
+            for name in os.listdir(directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(directory, name))  # Results pickled by version 2
+            self.connection.execute('PRAGMA user_version = %d' % self.VERSION)
+
+        # Keep the total size in memory
+        self.__bytes = self.connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+
+    ####################################################
+    # Public methods for caching results
+    ####################################################
+
+    def get(self, media_path, image):
+        """ Returns the cached results of an image (rescaled to its size) or None on a miss """
+
+        key = self.file_hash(media_path)
+
+        with self.__lock:
+            entry = self.connection.execute('SELECT key, height, width FROM entries WHERE key = ?',
+                                            (key,)).fetchone()
+            results = self.__load(entry)
+            if results:
+                self.hits += 1
+
+        # Fall back to the closest near duplicate, only hashing the pixels when the exact lookup misses
+        if not results and self.perceptual:
+            phash = self.perceptual_hash(image)
+            with self.__lock:
+                entry = self.__find_near_duplicate(phash, image.shape[:2])
+                results = self.__load(entry)
+                if results:
+                    self.near_hits += 1
+
+        if not results:
+            with self.__lock:
+                self.misses += 1
+            return None
+
+        key, height, width = entry
+        return self.__rescale(results, (height, width), image.shape[:2])
+
+    def put(self, media_path, image, face_locations, face_encodings, face_landmarks):
+        """ Stores the results of an image and evicts the least recently used ones beyond the size bound """
+
+        key = self.file_hash(media_path)
+        phash = self.perceptual_hash(image)
+
+        with self.__lock:
+
+            # Write the results next to the entry and move them in place so that readers never see a partial file
+            temporary_path = self.__entry_path(key) + '.tmp'
+            with open(temporary_path, 'wb') as entry_file:
+                numpy.savez(entry_file,
+                            face_locations=numpy.array(face_locations, dtype=numpy.int64).reshape(-1, 4),
+                            face_encodings=numpy.array(face_encodings, dtype=numpy.float64).reshape(-1, 128),
+                            face_landmarks=numpy.array(json.dumps(face_landmarks or [], default=int)))
+            os.replace(temporary_path, self.__entry_path(key))
+            size = os.path.getsize(self.__entry_path(key))
+
+            with self.connection:
+
+                # Replace a previous entry of the same key
+                self.__remove(key, delete=False)
+                self.connection.execute(
+                    'INSERT INTO entries (key, phash, height, width, bytes, used, %s) VALUES (%s)'
+                    % (', '.join(self.__band_columns), ', '.join('?' * (6 + self.HASH_BANDS))),
+                    [key, self.__signed(phash), image.shape[0], image.shape[1], size, time.time()]
+                    + self.__hash_bands(phash))
+                self.__bytes += size
+
+                self.__evict()
+
+    def clear(self):
+        """ Removes all the cached results """
+        with self.__lock:
+            with self.connection:
+                for (key,) in self.connection.execute('SELECT key FROM entries').fetchall():
+                    self.__remove(key)
+            self.__bytes = 0
+
+    def close(self):
+        """ Closes the index of the cache """
+        with self.__lock:
+            self.connection.close()
+
+    def stats(self):
+        """ Returns the cache metrics """
+        lookups = self.hits + self.near_hits + self.misses
+        with self.__lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'near-hits': self.near_hits,
+            'misses': self.misses,
+            'hit-rate': (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': self.__bytes
+        }
+
+    ####################################################
+    # Hash methods
+    ####################################################
+
+    @staticmethod
+    def file_hash(media_path):
+        """ Exact content hash of a file """
+        digest = hashlib.sha256()
+        with open(media_path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def perceptual_hash(image):
+        """ 64 bit difference hash (dHash) of decoded pixels: compares adjacent pixels of a 9x8 grayscale thumbnail """
+        pixels = numpy.asarray(Image.fromarray(image).convert('L').resize((9, 8), Image.LANCZOS), dtype=numpy.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        return int(sum(1 << bit for bit, on in enumerate(bits) if on))
+
+    ####################################################
+    # Utility methods
+    ####################################################
+
+    def __load(self, entry):
+        """ Loads the results of an index entry (key, height, width) and marks it as recently used
+        Returns None and removes the entry when its results file is missing or unreadable """
+
+        if not entry:
+            return None
+
+        key = entry[0]
+        try:
+            with numpy.load(self.__entry_path(key), allow_pickle=False) as entry_file:
+                results = {
+                    'face_locations': [tuple(location) for location in entry_file['face_locations'].tolist()],
+                    'face_encodings': list(entry_file['face_encodings']),
+                    'face_landmarks': [{feature: [tuple(point) for point in points]
+                                        for feature, points in landmark.items()}
+                                       for landmark in json.loads(str(entry_file['face_landmarks']))]
+                }
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            with self.connection:
+                self.__remove(key)
+            return None
+
+        with self.connection:
+            self.connection.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        return results
+
+    def __find_near_duplicate(self, phash, size):
+        """ Returns the (key, height, width) of the closest cached image within the threshold with the same
+        aspect ratio """
+
+        best_entry, best_distance = None, self.threshold + 1
+
+        # Only compare the candidates that share a band with the query
+        conditions = ' OR '.join('%s = ?' % column for column in self.__band_columns)
+        candidates = self.connection.execute('SELECT key, height, width, phash FROM entries WHERE %s' % conditions,
+                                             self.__hash_bands(phash)).fetchall()
+
+        for key, cached_height, cached_width, cached_phash in candidates:
+            distance = bin((cached_phash & 0xFFFFFFFFFFFFFFFF) ^ phash).count('1')
+            same_ratio = abs(cached_width / cached_height - size[1] / size[0]) < 0.02 * size[1] / size[0]
+            if distance < best_distance and same_ratio:
+                best_entry, best_distance = (key, cached_height, cached_width), distance
+
+        return best_entry
+
+    def __hash_bands(self, phash):
+        """ Splits a perceptual hash into its band values """
+        width = 64 // self.HASH_BANDS
+        return [(phash >> (band * width)) & ((1 << width) - 1) for band in range(self.HASH_BANDS)]
+
+    @staticmethod
+    def __signed(phash):
+        """ Brings a 64 bit hash into the signed range of SQLite integers """
+        return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+    def __remove(self, key, delete=True):
+        """ Removes a key from the index and optionally its entry file. Runs within a transaction """
+        entry = self.connection.execute('SELECT bytes FROM entries WHERE key = ?', (key,)).fetchone()
+        if entry:
+            self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.__bytes -= entry[0]
+        if delete and os.path.exists(self.__entry_path(key)):
+            os.remove(self.__entry_path(key))
+
+    def __evict(self):
+        """ Removes the least recently used entries until the cache fits in its size bound """
+        while self.__bytes > self.max_bytes:
+            oldest = self.connection.execute('SELECT key FROM entries ORDER BY used LIMIT 16').fetchall()
+            if not oldest:
+                return
+            for (key,) in oldest:
+                if self.__bytes <= self.max_bytes:
+                    return
+                self.__remove(key)
+
+    def __entry_path(self, key):
+        """ Path of the results file of a key """
+        return os.path.join(self.directory, key + '.npz')
+
+    @staticmethod
+    def __rescale(results, cached_size, size):
+        """ Rescales the cached locations and landmarks to the size of the queried image """
+
+        scale_y, scale_x = size[0] / cached_size[0], size[1] / cached_size[1]
+        if scale_y == 1 and scale_x == 1:
+            return results
+
+        results['face_locations'] = [(int(round(top * scale_y)), int(round(right * scale_x)),
+                                      int(round(bottom * scale_y)), int(round(left * scale_x)))
+                                     for (top, right, bottom, left) in results['face_locations']]
+        results['face_landmarks'] = [{feature: [(int(round(x * scale_x)), int(round(y * scale_y)))
+                                                for (x, y) in points] for feature, points in landmark.items()}
+                                     for landmark in results['face_landmarks']]
+        return results
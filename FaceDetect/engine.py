@@ -0,0 +1,199 @@
+# engine.py
+#
+# Stateless face detection and recognition engine that can be shared by FaceDetect instances and threads
+#
+# Usage:
+#  - Instantiate a FaceEngine once, with the known faces if recognition is needed
+#  - Pass it to as many FaceDetect instances as needed: FaceDetect(settings, engine=engine)
+#  - Or call engine.detect(image) directly from worker threads. Every call returns its own FaceResult
+#
+# The engine only holds read-only data (the known faces), so concurrent calls do not share any mutable state.
+# Threads only run the calls in parallel if dlib releases the GIL: main_concurrency_stress.py measures the speedup.
+# For parallel throughput regardless, run the detections in worker processes (see transport.py).
+
+from collections.abc import Mapping
+import numpy
+import face_recognition
+
+
+class FaceResult:
+    """ Results of a single detection call """
+
+    def __init__(self, face_locations=None, face_encodings=None, face_landmarks=None, face_labels=None,
+                 face_distances=None, encoding_ages=None):
+        """ Initializes the results of a detection call """
+        self.face_locations = face_locations or []  # Face locations
+        self.face_encodings = face_encodings or []  # Face encodings
+        self.face_landmarks = face_landmarks or []  # Face landmarks
+        self.face_labels = face_labels or []  # Face labels
+        self.face_distances = face_distances or []  # Distances of the recognized faces to their best known face match
+        self.encoding_ages = encoding_ages or []  # Frames since each encoding was computed (0 when fresh)
+
+    @property
+    def detections(self):
+        """ Zipped version of (face_location, label) or None when there are no faces """
+        return list(zip(self.face_locations, self.face_labels)) if self.face_locations else None
+
+    def __str__(self):
+        """ Stringify the result by exposing the detections and recognitions """
+        return ''.join('(%s, %s)' % (location, label) for location, label in self.detections or [])
+
+
+class FaceEngine:
+    """ Shareable engine that detects and recognizes faces without keeping any per call state """
+
+    TRACKING_IOU = 0.5  # Minimum overlap for a face to be the same as a face of the previous frame
+    ENCODING_MAX_AGE = 10  # Reused encodings are computed again after this number of frames
+
+    def __init__(self, known_faces=None, tolerance=0.6):
+        """ Loads the known faces: a dictionary of face labels and image paths associated """
+
+        self.tolerance = tolerance
+        labels, encodings = [], []
+
+        # Iterate through the known faces and load the images
+        for (known_face_label, image_path) in (known_faces if isinstance(known_faces, Mapping) else {}).items():
+            try:
+                loaded_image = face_recognition.load_image_file(image_path)
+                encodings.append(face_recognition.face_encodings(loaded_image)[0])
+                labels.append(known_face_label)
+
+            # Raise FileNotFoundError onto a FaceDetect Exception
+            except FileNotFoundError:
+                raise Exception("Some of the image paths provided are invalid")
+
+            # Raise any other Exception on a FaceDetect Exception
+            except Exception:
+                raise Exception("We were not able to start face recognition")
+
+        # Freeze the known faces so that they can be shared safely
+        self.known_faces_labels = tuple(labels)
+        self.known_faces_encodings = numpy.array(encodings).reshape(len(encodings), 128)
+        self.known_faces_encodings.setflags(write=False)
+
+    ####################################################
+    # Public methods for face detection and recognition
+    ####################################################
+
+    def detect(self, image, ratio=1, landmarks=True, recognize=False, previous=None):
+        """ Detects the faces of an RGB image and returns a FaceResult
+        - ratio: factor that brings the locations and landmarks back to original size if the image was downscaled
+        - landmarks: computes the face landmarks
+        - recognize: labels the faces with the known faces
+        - previous: FaceResult of the previous frame whose encodings are reused for the faces that are still tracked
+          (matched one to one by overlap, and encoded again every ENCODING_MAX_AGE frames) """
+
+        # Find all the faces in the image
+        face_locations = face_recognition.face_locations(image)
+
+        # Find the faces encodings, reusing those of the tracked faces
+        if previous and previous.face_locations:
+            face_encodings, encoding_ages = self.__track_encodings(image, ratio, face_locations, previous)
+        else:
+            face_encodings = face_recognition.face_encodings(image, face_locations)
+            encoding_ages = [0] * len(face_locations)
+
+        # Find all the faces landmarks on the detected locations
+        face_landmarks = face_recognition.face_landmarks(image, face_locations) if landmarks else []
+
+        # Resize the data to bring to original size
+        if ratio != 1:
+            face_locations = [(top * ratio, right * ratio, bottom * ratio, left * ratio)
+                              for (top, right, bottom, left) in face_locations]
+            for landmark in face_landmarks:
+                for feature in landmark:
+                    landmark[feature] = [(x * ratio, y * ratio) for (x, y) in landmark[feature]]
+
+        # Iterate through the detected face locations and append an unknown label
+        face_labels = ["Face " + str(count + 1) for count in range(len(face_locations))]
+
+        result = FaceResult(face_locations, face_encodings, face_landmarks, face_labels, encoding_ages=encoding_ages)
+
+        if recognize:
+            result.face_labels, result.face_distances = self.recognize(face_encodings)
+
+        return result
+
+    def recognize(self, face_encodings):
+        """ Compares face encodings to the known faces and returns their labels and best match distances """
+
+        face_labels, face_distances = [], []
+
+        # Iterate through the different face_encodings identified
+        for face_encoding in face_encodings:
+
+            # Default label is unknown
+            label = 'Unknown'
+            distance = None
+
+            if len(self.known_faces_labels):
+
+                # Find the best match based on the face distances
+                distances = face_recognition.face_distance(self.known_faces_encodings, face_encoding)
+                best_match = int(numpy.argmin(distances))
+                distance = float(distances[best_match])
+
+                # When a best match use the label provided as the label
+                if distance <= self.tolerance:
+                    label = self.known_faces_labels[best_match]
+
+            # Append the face label and distance to the collections
+            face_labels.append(label)
+            face_distances.append(distance)
+
+        return face_labels, face_distances
+
+    ####################################################
+    # Utility methods
+    ####################################################
+
+    def __track_encodings(self, image, ratio, face_locations, previous):
+        """ Reuses the encodings of faces matched one to one with a face of the previous frame and encodes the others
+        Returns the encodings and their ages in frames """
+
+        encodings = [None] * len(face_locations)
+        ages = [0] * len(face_locations)
+
+        # Bring the locations to original size to compare with the previous frame
+        scaled_locations = [tuple(value * ratio for value in location) for location in face_locations]
+
+        # Score the pairs of current and previous faces whose encodings are still fresh enough to be reused
+        previous_ages = previous.encoding_ages or [0] * len(previous.face_locations)
+        pairs = []
+        for index, location in enumerate(scaled_locations):
+            for previous_index, previous_location in enumerate(previous.face_locations):
+                if previous_ages[previous_index] + 1 >= self.ENCODING_MAX_AGE:
+                    continue
+                overlap = self.__intersection_over_union(location, previous_location)
+                if overlap >= self.TRACKING_IOU:
+                    pairs.append((overlap, index, previous_index))
+
+        # Match the faces one to one, best overlap first
+        matched_previous = set()
+        for overlap, index, previous_index in sorted(pairs, reverse=True):
+            if encodings[index] is None and previous_index not in matched_previous:
+                encodings[index] = previous.face_encodings[previous_index]
+                ages[index] = previous_ages[previous_index] + 1
+                matched_previous.add(previous_index)
+
+        # Only encode the faces that are not tracked
+        untracked = [index for index, encoding in enumerate(encodings) if encoding is None]
+        if untracked:
+            new_encodings = face_recognition.face_encodings(image, [face_locations[index] for index in untracked])
+            for index, encoding in zip(untracked, new_encodings):
+                encodings[index] = encoding
+
+        return encodings, ages
+
+    @staticmethod
+    def __intersection_over_union(location, other_location):
+        """ Intersection over union of two (top, right, bottom, left) boxes """
+        top, right, bottom, left = location
+        other_top, other_right, other_bottom, other_left = other_location
+        width = min(right, other_right) - max(left, other_left)
+        height = min(bottom, other_bottom) - max(top, other_top)
+        if width <= 0 or height <= 0:
+            return 0.0
+        intersection = width * height
+        union = (right - left) * (bottom - top) + (other_right - other_left) * (other_bottom - other_top) - intersection
+        return intersection / union if union > 0 else 0.0
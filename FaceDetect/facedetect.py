@@ -11,7 +11,9 @@
 #  - This will automatically start face detection
 #
 # Customize Face Detection:
-#  - Pass a settings dictionary to the FaceDetect constructor
+#  - Pass a settings dictionary to the FaceDetect constructor. The settings are copied and cannot be changed afterwards
+#  - Optionally pass a FaceEngine to share the loaded known faces between several FaceDetect instances or threads.
+#    The known faces then come from the engine: a 'known-faces' setting with other labels raises an exception
 #  - Setting capabilities:
 #   * mode:  image or video (default)
 #   * custom: False (default). Set to True when the FaceDetect class is extended
@@ -20,15 +22,26 @@
 #   * print: prints the face locations and labels on the console
 #   * face-extraction: extracts captures of the faces into their own images. Applicable only to mode image
 #   * face-features: Draws the specified face features. Off by default. Pass the list ['face'] to draw the whole face
+#   * target-fps: Frame rate that a live stream should keep up with. Off by default
+#   * latency-budget: Per-frame latency budget in milliseconds. Takes precedence over target-fps. Off by default
+#   * results-store: Database path or ResultsStore where the detections are persisted for querying. Off by default
+#   * result-cache: Directory or ResultCache where the results of repeated images are cached. Applicable only to mode image
 #
 # Dory Azar
 # December 2020
 
 import os
+import time
+from types import MappingProxyType
+from collections.abc import Mapping
 import cv2
 from PIL import Image
 import numpy
 import face_recognition
+from .engine import FaceEngine, FaceResult
+from .latency import LatencyController
+from .store import ResultsStore
+from .cache import ResultCache
 
 
 class FaceDetect:
@@ -45,18 +58,24 @@ class FaceDetect:
         'face-extraction': False,
         'print': True,
         'face-features': [],
-        'known-faces': {}
+        'known-faces': {},
+        'target-fps': 0,
+        'latency-budget': 0,
+        'results-store': None,
+        'result-cache': None
     }
+    PATH_SETTINGS = ['results-store', 'result-cache']  # Settings whose string values are paths and keep their case
     ACCEPTED_VIDEO_FORMAT = ['avi', 'mp4', 'mov']
     ACCEPTED_IMAGE_FORMAT = ['jpeg', 'jpg', 'gif', 'png']
 
-    def __init__(self, settings=None):
+    def __init__(self, settings=None, engine=None):
         """ Initializes the Face Detect framework"""
 
         # Initialize default properties
         self.canvas = cv2
         self.stream = None
-        self.settings = self.DEFAULT_SETTINGS
+        self.engine = engine  # Face engine, shareable between instances and threads
+        self.result = FaceResult()  # Results of the last detection
 
         # Initialize face detection and recognition properties
         self.frame = None  # The detection frame
@@ -66,20 +85,36 @@ class FaceDetect:
         self.detections = None  # Face detection results
         self.face_landmarks = None  # Face landmarks
         self.face_extracts = []  # Collection of face extracted face images
-
-        # Populating setting from input (overrides are possible)
+        self.face_locations = []  # Face locations
+        self.face_encodings = []  # Face encodings
+        self.face_distances = []  # Distances of the recognized faces to their best known face match
+        self.qos = None  # Latency controller of live streams
+        self.store = None  # Results store where the detections are persisted
+        self.__owned_store = False  # Whether the results store was opened from a path and is closed after a run
+        self.cache = None  # Result cache of repeated images
+        self.__owned_cache = False  # Whether the result cache was opened from a directory and is closed after a run
+        self.source = None  # Path of the media being detected ('webcam' for the webcam)
+        self.frame_index = 0  # Index of the detection frame in the media
+
+        # Populating setting from input on a frozen copy of the defaults (overrides are possible)
+        instance_settings = {setting: self.__freeze(val) for setting, val in self.DEFAULT_SETTINGS.items()}
         if settings:
             for setting in settings:
 
                 # Sanitize the key
                 sanitized_setting = setting.lower()
 
-                # Get the value and sanitize if string, otherwise take as is
+                # Get the value and sanitize if string (paths keep their case), otherwise take as is
                 val = settings.get(setting)
-                val = val.lower().strip() if type(val) is str else val
+                if type(val) is str:
+                    val = val.strip() if sanitized_setting in self.PATH_SETTINGS else val.lower().strip()
+
+                # Set the settings to the sanitized keys and frozen copies of the values
+                instance_settings[sanitized_setting] = self.__freeze(val) if type(val) is bool or val \
+                    else instance_settings.get(sanitized_setting)
 
-                # Set the settings to the sanitized keys and values
-                self.settings[sanitized_setting] = val if type(val) is bool or val else self.settings[sanitized_setting]
+        # Freeze the settings of the instance
+        self.settings = MappingProxyType(instance_settings)
 
     ####################################################
     # Public methods for face detection and recognition
@@ -113,6 +148,17 @@ class FaceDetect:
         except Exception as error:
             raise Exception(error)
 
+        # Persist the pending detections and close the results store and result cache opened from a path
+        finally:
+            if self.store and self.__owned_store:
+                self.store.close()
+                self.store, self.__owned_store = None, False
+            elif self.store:
+                self.store.flush()
+            if self.cache and self.__owned_cache:
+                self.cache.close()
+                self.cache, self.__owned_cache = None, False
+
     ####################################################
     # Detection mechanisms
     # - Static: For images
@@ -127,13 +173,24 @@ class FaceDetect:
             raise Exception('Provide a valid image file')
 
         # Load the image in cv2 for display
+        self.source, self.frame_index = media_path, 0
         self.frame = self.canvas.imread(media_path)
 
         # Load the image in face_recognition for calculations
         self.stream = face_recognition.load_image_file(media_path)
 
-        # Start the detection
-        self.__detect()
+        # Reuse the results of the same (or a near identical) image if they are cached
+        results = self.cache.get(media_path, self.stream) if self.cache else None
+        if results:
+            self.result = FaceResult(results['face_locations'], results['face_encodings'], results['face_landmarks'],
+                                     ["Face " + str(count + 1) for count in range(len(results['face_locations']))])
+            self.__apply_result(self.result)
+
+        # Otherwise start the detection and cache its results
+        else:
+            self.__detect()
+            if self.cache:
+                self.cache.put(media_path, self.stream, self.face_locations, self.face_encodings, self.face_landmarks)
 
         # Call a native or custom callback method
         self.__callback()
@@ -161,19 +218,34 @@ class FaceDetect:
         # Keep displaying as long as stream is open
         while self.stream and self.stream.isOpened():
 
-            ret, self.frame = self.stream.read()
-            if ret:
-                # Start the detection
-                self.__detect()
+            # Drop the frame without decoding it when the latency controller is shedding load
+            if self.qos and self.qos.should_drop():
+                self.stream.grab()
+
+            else:
+                ret, self.frame = self.stream.read()
+                if ret:
+                    self.frame_index += 1
+
+                    # Time the processing of the frame against the latency budget
+                    # (the timer starts once the frame is read so that waiting for the camera is not counted)
+                    if self.qos:
+                        self.qos.start_frame()
 
-                # Call a native or custom callback method
-                self.__callback()
+                    # Start the detection
+                    self.__detect()
 
-                # Execute Settings if there are detections
-                if self.detections:
-                    self.__execute_setting()
+                    # Call a native or custom callback method
+                    self.__callback()
 
-                self.canvas.imshow('FaceDetect', self.frame)
+                    # Execute Settings if there are detections
+                    if self.detections:
+                        self.__execute_setting()
+
+                    self.canvas.imshow('FaceDetect', self.frame)
+
+                    if self.qos:
+                        self.qos.end_frame()
 
             # Close when 'q' is pressed
             if self.canvas.waitKey(1) & 0xFF == ord('q'):
@@ -186,70 +258,69 @@ class FaceDetect:
     def __preload(self):
         """ Assesses the provided (or default) settings and preloads features """
 
-        # With recognition activated
-        if self.__get_setting('method') == 'recognize':
-
-            #  Get the known face files provided
-            known_faces = self.__get_setting('known-faces')
-            known_faces = known_faces if type(known_faces) is dict else {}
-
-            # Get the list of tuples from the setting input
-            known_faces = [(known_face_label, image_path) for known_face_label, image_path in known_faces.items()]
-
-            # Iterate through each setting input and load the images
-            for (known_face_label, image_path) in known_faces:
-                try:
-                    loaded_image = face_recognition.load_image_file(image_path)
-                    self.known_faces_encodings.append(face_recognition.face_encodings(loaded_image)[0])
-                    self.known_faces_labels.append(known_face_label)
+        # With a latency budget on a live stream, start the latency controller
+        target_fps = self.__get_setting('target-fps')
+        latency_budget = self.__get_setting('latency-budget')
+        if self.__get_setting('mode') != 'image' and (target_fps or latency_budget):
+            self.qos = LatencyController(target_fps, latency_budget)
+
+        # With a results store, open it unless a ResultsStore object is provided
+        results_store = self.__get_setting('results-store')
+        if results_store and not self.store:
+            self.__owned_store = not isinstance(results_store, ResultsStore)
+            self.store = ResultsStore(results_store) if self.__owned_store else results_store
+
+        # With a result cache in mode image, open it unless a ResultCache object is provided
+        result_cache = self.__get_setting('result-cache')
+        if self.__get_setting('mode') == 'image' and result_cache and not self.cache:
+            self.__owned_cache = not isinstance(result_cache, ResultCache)
+            self.cache = ResultCache(result_cache) if self.__owned_cache else result_cache
+
+        # Reset the state of the previous run
+        self.result = FaceResult()
+        self.__apply_result(self.result)
+        self.face_extracts = []
+
+        # Load the engine once, with the known faces when recognition is activated
+        is_recognize = self.__get_setting('method') == 'recognize'
+        known_faces = self.__get_setting('known-faces') if is_recognize else None
+        if not self.engine:
+            self.engine = FaceEngine(known_faces)
 
-                # Raise FileNotFoundError onto a FaceDetect Exception
-                except FileNotFoundError:
-                    raise Exception("Some of the image paths provided are invalid")
+        # A shared engine holds its own known faces: refuse known faces that it does not hold
+        elif isinstance(known_faces, Mapping) and set(known_faces) != set(self.engine.known_faces_labels):
+            raise Exception("The known-faces setting does not match the known faces of the provided engine")
 
-                # Raise any other Exception on a FaceDetect Exception
-                except Exception:
-                    raise Exception("We were not able to start face recognition")
+        # Expose the known faces of the engine
+        self.known_faces_encodings = list(self.engine.known_faces_encodings)
+        self.known_faces_labels = list(self.engine.known_faces_labels)
 
     def __detect(self):
         """ Detects faces in the media provided and calls on drawing or printing locations out """
 
         # Initialize variables
         mode = self.__get_setting('mode')
-        self.face_labels = []
 
-        # Resize frame of video to 1/4 size for faster face detections
-        small_frame = self.canvas.resize(self.frame, (0, 0), fx=0.25, fy=0.25)
+        # Resize frame of video to 1/4 size (or smaller under load) for faster face detections
+        scale = self.qos.scale if self.qos else 0.25
+        small_frame = self.canvas.resize(self.frame, (0, 0), fx=scale, fy=scale)
 
         # If it's video, convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
         # If it is an image take the stream
         rgb_small_frame = small_frame[:, :, ::-1] if mode != 'image' else self.stream
 
-        # Find all the faces in the frame and their encodings
-        self.face_locations = face_recognition.face_locations(rgb_small_frame)
-        self.face_encodings = face_recognition.face_encodings(rgb_small_frame, self.face_locations)
-
-        # Find all the faces landmarks
-        self.face_landmarks = face_recognition.face_landmarks(rgb_small_frame)
-        # Resize the data to match original size
-        if mode != 'image':
+        # Resize the data to match original size unless it is an image
+        ratio = int(round(1 / scale)) if mode != 'image' else 1
 
-            # Resize data to bring to original size
-            self.face_locations = [(top*4, bottom*4, left*4, right*4) for (top, bottom, left, right)
-                                   in self.face_locations]
-
-            # Resize the data to bring to original size
-            for landmark in self.face_landmarks:
-                for feature in landmark:
-                    landmark[feature] = [(x * 4, y * 4) for (x, y) in landmark[feature]]
-
-        # Iterate through the detected face locations and append an unknown label
-        for count, location in enumerate(self.face_locations):
-            label = "Face " + str(count + 1)
-            self.face_labels.append(label)
+        # Find all the faces in the frame with their encodings and landmarks
+        # Under load, the landmarks are shed and the encodings of the faces tracked from the previous frame are reused,
+        # except on the first frame after a level change where all the faces are encoded again
+        reuse_encodings = self.qos and self.qos.reuse_encodings and self.qos.level_frames > 0
+        self.result = self.engine.detect(rgb_small_frame, ratio, landmarks=not self.qos or self.qos.landmarks,
+                                         previous=self.result if reuse_encodings else None)
 
         # Upon face detection
-        self.__generate_detections()
+        self.__apply_result(self.result)
 
     def __callback(self):
         """ Callback method that will run at every fetching interval and that will execute
@@ -283,6 +354,10 @@ class FaceDetect:
         if self.__get_setting('print'):
             print(self)
 
+        # Persist the detections in the results store
+        if self.store:
+            self.__record_detections()
+
         # Draw detections if they are available and the setting is on
         if self.__get_setting('draw'):
             self.__draw_detections()
@@ -297,7 +372,7 @@ class FaceDetect:
         features = self.__get_setting('face-features')
 
         # Force to an empty list if
-        features = [] if type(features) is not list else list(map(str.lower, features))
+        features = [] if not isinstance(features, (list, tuple)) else list(map(str.lower, features))
 
         # Default features to be drawn unless specified
         features = self.FACE_FEATURES if 'face' in features else features
@@ -310,31 +385,27 @@ class FaceDetect:
 
         if self.face_encodings:
 
-            # Clear the face labels to prepare for recognition
-            self.face_labels = []
-
-            # Iterate through the different face_encodings identified
-            for face_encoding in self.face_encodings:
+            # Label the faces with the best known face matches
+            self.result.face_labels, self.result.face_distances = self.engine.recognize(self.face_encodings)
 
-                # Default label is unknown
-                label = 'Unknown'
-
-                # Compare the face encodings and get all the potential matches
-                face_matches = face_recognition.compare_faces(self.known_faces_encodings, face_encoding)
-
-                # Find the best match based on the face distances
-                face_distances = face_recognition.face_distance(self.known_faces_encodings, face_encoding)
-                best_match = int(numpy.argmin(face_distances))
+            # Update the detections account for the  new names
+            self.__apply_result(self.result)
 
-                # When a best match use the label provided as the label
-                if face_matches[best_match]:
-                    label = self.known_faces_labels[best_match]
+    def __record_detections(self):
+        """ Appends the detections of the current frame to the results store """
 
-                # Append the face label to the collection
-                self.face_labels.append(label)
+        # Detections of a video file are timed by their position in the video (seconds), the others by the clock
+        if self.__get_setting('mode') != 'image' and self.source != 'webcam':
+            timestamp = self.stream.get(self.canvas.CAP_PROP_POS_MSEC) / 1000
+        else:
+            timestamp = time.time()
+        is_recognize = self.__get_setting('method') == 'recognize'
 
-            # Update the detections account for the  new names
-            self.__generate_detections()
+        # Iterate through the detections along with their encodings and distances
+        for index, (location, label) in enumerate(self.detections):
+            encoding = self.face_encodings[index] if index < len(self.face_encodings) else None
+            distance = self.face_distances[index] if is_recognize and index < len(self.face_distances) else None
+            self.store.append(self.source, self.frame_index, timestamp, location, label, distance, encoding)
 
     ####################################################
     # OpenCV & PIL  Utility methods
@@ -345,6 +416,7 @@ class FaceDetect:
 
         # If invalid media video, it will open the video cam by default
         media_input = media_input if media_input and self.__is_valid_media('video', media_input) else 0
+        self.source, self.frame_index = media_input or 'webcam', 0
         self.stream = self.canvas.VideoCapture(media_input)
 
     def __draw_detections(self):
@@ -431,21 +503,29 @@ class FaceDetect:
             return True
         return False
 
+    @staticmethod
+    def __freeze(value):
+        """ Returns a read-only copy of a setting value: lists become tuples and dictionaries read-only mappings """
+        if isinstance(value, Mapping):
+            return MappingProxyType({key: FaceDetect.__freeze(val) for key, val in value.items()})
+        if isinstance(value, (list, tuple, set)):
+            return tuple(FaceDetect.__freeze(val) for val in value)
+        return value
+
     def __get_setting(self, key):
         """ Getter to get a value from the settings """
         if key.lower() in self.settings and self.settings[key]:
             return self.settings[key]
         return None
 
-    def __generate_detections(self):
-        """ Generates and updates the detections """
-
-        # Condense the face locations and labels into tuples
-        self.detections = zip(self.face_locations, self.face_labels) if self.face_locations else None
-
-        # Format onto tuples if there are self detections
-        if self.detections:
-            self.detections = [(detection[0], detection[1]) for detection in self.detections]
+    def __apply_result(self, result):
+        """ Exposes the results of a detection through the FaceDetect properties """
+        self.face_locations = result.face_locations
+        self.face_encodings = result.face_encodings
+        self.face_landmarks = result.face_landmarks
+        self.face_labels = result.face_labels
+        self.face_distances = result.face_distances
+        self.detections = result.detections
 
     def __end(self):
         """ Ends the show """
@@ -0,0 +1,175 @@
+# latency.py
+#
+# Quality of service controller that keeps live FaceDetect streams within a per-frame latency budget
+#
+# Usage:
+#  - Pass a 'target-fps' or a 'latency-budget' (in milliseconds) setting to the FaceDetect constructor
+#  - FaceDetect times every frame and the controller degrades the detection quality under load:
+#   * level 0: full quality
+#   * level 1: skip the face landmarks
+#   * level 2: lower the detection scale
+#   * level 3: reuse the encodings of faces that are already tracked from the previous frame
+#   * level 4: drop frames: every other frame, or as many frames as the last processed frame overran the budget
+#  - The controller recovers one level at a time when the load falls
+#  - The current level and the deadline miss counters are exposed through FaceDetect.qos
+
+import math
+import time
+
+
+class LatencyController:
+    """ Degrades and recovers detection quality to keep every frame within a latency budget """
+
+    # Degradation levels ordered from full quality to maximum load shedding
+    LEVELS = [
+        {'scale': 0.25, 'landmarks': True, 'reuse-encodings': False, 'frame-skip': 1},
+        {'scale': 0.25, 'landmarks': False, 'reuse-encodings': False, 'frame-skip': 1},
+        {'scale': 0.125, 'landmarks': False, 'reuse-encodings': False, 'frame-skip': 1},
+        {'scale': 0.125, 'landmarks': False, 'reuse-encodings': True, 'frame-skip': 1},
+        {'scale': 0.125, 'landmarks': False, 'reuse-encodings': True, 'frame-skip': 2},
+    ]
+
+    def __init__(self, target_fps=None, latency_budget=None, degrade_after=3, recover_after=30, recover_ratio=0.6):
+        """ Initializes the controller from a target fps or a latency budget in milliseconds """
+
+        # The latency budget takes precedence over the target fps
+        if latency_budget:
+            self.budget = float(latency_budget) / 1000
+        elif target_fps:
+            self.budget = 1.0 / float(target_fps)
+        else:
+            raise Exception("Provide a target fps or a latency budget")
+
+        if self.budget <= 0:
+            raise Exception("The latency budget must be positive")
+
+        # Number of consecutive misses before degrading and of consecutive fast frames before recovering
+        self.degrade_after = degrade_after
+        self.recover_after = recover_after
+
+        # A frame only counts towards recovery if it is well under the budget
+        self.recover_ratio = recover_ratio
+
+        # Initialize the controller state and counters
+        self.level = 0
+        self.frames = 0  # Processed frames
+        self.dropped_frames = 0  # Frames dropped by load shedding
+        self.deadline_misses = 0  # Processed frames that exceeded the budget
+        self.last_latency = 0.0  # Latency of the last processed frame in seconds
+        self.level_frames = 0  # Processed frames since the last level change
+        self.__consecutive_misses = 0
+        self.__consecutive_hits = 0
+        self.__frame_start = None
+        self.__frame_count = 0
+        self.__overrun_skip = 1  # Frame skip measured from the overrun at the last level
+
+    ####################################################
+    # Public methods for frame timing
+    ####################################################
+
+    def should_drop(self):
+        """ Tells whether the next frame should be dropped to shed load """
+
+        self.__frame_count += 1
+        if self.__frame_count % self.frame_skip:
+            self.dropped_frames += 1
+            return True
+        return False
+
+    def start_frame(self):
+        """ Marks the start of a processed frame """
+        self.__frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """ Marks the end of a processed frame and adjusts the degradation level """
+
+        if self.__frame_start is None:
+            return self.last_latency
+
+        self.last_latency = time.perf_counter() - self.__frame_start
+        self.__frame_start = None
+        self.frames += 1
+        self.level_frames += 1
+
+        # At the last level, skip the frames that arrived while the last frame was processed
+        if self.level == len(self.LEVELS) - 1:
+            self.__overrun_skip = int(math.ceil(self.last_latency / self.budget))
+
+        # Missed the deadline: degrade once enough consecutive frames were late
+        if self.last_latency > self.budget:
+            self.deadline_misses += 1
+            self.__consecutive_misses += 1
+            self.__consecutive_hits = 0
+            if self.__consecutive_misses >= self.degrade_after:
+                self.__set_level(self.level + 1)
+
+        # Comfortably within the deadline: recover once the load has stayed low long enough
+        elif self.last_latency < self.budget * self.recover_ratio:
+            self.__consecutive_hits += 1
+            self.__consecutive_misses = 0
+            if self.__consecutive_hits >= self.recover_after:
+                self.__set_level(self.level - 1)
+
+        # Within the deadline but with little headroom: hold the current level
+        else:
+            self.__consecutive_misses = 0
+            self.__consecutive_hits = 0
+
+        return self.last_latency
+
+    def stats(self):
+        """ Returns a snapshot of the controller state """
+        return {
+            'level': self.level,
+            'budget': self.budget,
+            'last-latency': self.last_latency,
+            'frames': self.frames,
+            'dropped-frames': self.dropped_frames,
+            'deadline-misses': self.deadline_misses
+        }
+
+    ####################################################
+    # Current degradation level properties
+    ####################################################
+
+    @property
+    def scale(self):
+        """ Scale applied to the frame before detection """
+        return self.LEVELS[self.level]['scale']
+
+    @property
+    def landmarks(self):
+        """ Whether the face landmarks are computed """
+        return self.LEVELS[self.level]['landmarks']
+
+    @property
+    def reuse_encodings(self):
+        """ Whether the encodings of already tracked faces are reused """
+        return self.LEVELS[self.level]['reuse-encodings']
+
+    @property
+    def frame_skip(self):
+        """ One frame out of frame_skip is processed """
+        if self.level == len(self.LEVELS) - 1:
+            return max(self.LEVELS[self.level]['frame-skip'], self.__overrun_skip)
+        return self.LEVELS[self.level]['frame-skip']
+
+    ####################################################
+    # Utility methods
+    ####################################################
+
+    def __set_level(self, level):
+        """ Moves to a new degradation level and resets the consecutive counters """
+        level = max(0, min(level, len(self.LEVELS) - 1))
+        if level != self.level:
+            self.level = level
+            self.level_frames = 0
+            self.__overrun_skip = 1
+        self.__consecutive_misses = 0
+        self.__consecutive_hits = 0
+
+    def __str__(self):
+        """ Stringify the controller by exposing its state """
+        return 'QoS level %s: %s frames, %s dropped, %s deadline misses (last %.1f ms / budget %.1f ms)' % (
+            self.level, self.frames, self.dropped_frames, self.deadline_misses,
+            self.last_latency * 1000, self.budget * 1000)
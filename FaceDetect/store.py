@@ -0,0 +1,252 @@
+# store.py
+#
+# Results store that persists FaceDetect detections in SQLite for later querying
+#
+# Usage:
+#  - Pass a 'results-store' setting to the FaceDetect constructor: a database path or a ResultsStore object
+#  - Every detection is appended with its source, frame index, timestamp, box, label, distance and encoding
+#  - Inserts are batched and flushed when the detection ends
+#  - Query the store:
+#   * appearances('John'): when did a label appear (uses the label index)
+#   * similar('person1.png'): which frames have faces similar to an image (uses a locality sensitive hash index
+#     of the encodings so that only the candidates in the nearby buckets are compared)
+#
+# Similarity index: 12 independent hash tables of 16 random hyperplanes each. A query probes, in every table, the
+# buckets within 2 bits of its own bucket. Face encodings are not spread around the origin but clustered around a
+# mean face: the encodings are centered on a mean encoding before hashing, otherwise every hyperplane would cut the
+# cluster the same way and most of the stored faces would share the buckets of any query.
+# The mean encoding is computed from the first CENTER_SAMPLES encodings (or provided) and stored with the database
+# so that the buckets stay valid across runs. Until then, the few encodings without buckets are always compared.
+# main_store_recall.py measures the recall and the fraction of compared faces against a brute force scan.
+
+import sqlite3
+import itertools
+import threading
+import numpy
+import face_recognition
+
+
+class ResultsStore:
+    """ Append-only SQLite store of detections with a label index and an encoding similarity index """
+
+    # Locality sensitive hash of the encodings: sign of the projections on random hyperplanes
+    HASH_TABLES = 12
+    HASH_BITS = 16
+    PROBE_RADIUS = 2
+    HASH_SEED = 20201201
+    ENCODING_SIZE = 128
+    CENTER_SAMPLES = 256  # Number of encodings whose mean centers the encodings before hashing
+
+    def __init__(self, path='detections.db', batch_size=500, encodings=True, center=None):
+        """ Opens (or creates) the store at the given path
+        The encodings are centered on the center encoding stored with the database, else on the given one, else on
+        the mean of the first encodings """
+
+        self.path = path
+        self.batch_size = batch_size
+        self.encodings = encodings  # Whether the face encodings are stored (the similarity queries need them)
+        self.candidates = 0  # Number of stored faces compared by the last similarity query
+        self.__pending = []
+        self.__lock = threading.RLock()  # The store can be shared by FaceDetect instances running in threads
+
+        # Same hyperplanes for every store so that the buckets stay valid across runs
+        self.__hyperplanes = numpy.random.RandomState(self.HASH_SEED).randn(self.HASH_TABLES * self.HASH_BITS,
+                                                                           self.ENCODING_SIZE)
+
+        # Bucket offsets probed around the bucket of a query
+        self.__probes = [sum(1 << bit for bit in bits) for radius in range(self.PROBE_RADIUS + 1)
+                         for bits in itertools.combinations(range(self.HASH_BITS), radius)]
+
+        # One bucket column per hash table, each with its own index
+        self.__bucket_columns = ['bucket_%d' % table for table in range(self.HASH_TABLES)]
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY,
+                source TEXT,
+                frame INTEGER,
+                timestamp REAL,
+                top INTEGER,
+                right INTEGER,
+                bottom INTEGER,
+                left INTEGER,
+                label TEXT,
+                distance REAL,
+                %s,
+                encoding BLOB
+            );
+            CREATE INDEX IF NOT EXISTS detections_label ON detections (label, timestamp);
+            CREATE INDEX IF NOT EXISTS detections_frame ON detections (source, frame);
+        """ % ',\n'.join('%s INTEGER' % column for column in self.__bucket_columns))
+        for column in self.__bucket_columns:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS detections_%s ON detections (%s)' % (column, column))
+
+        # Use the center of the database, or store the given one
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value BLOB)')
+        stored = self.connection.execute("SELECT value FROM metadata WHERE key = 'center'").fetchone()
+        self.__center = numpy.frombuffer(stored[0], dtype=numpy.float64) if stored else None
+        if center is not None:
+            center = numpy.asarray(center, dtype=numpy.float64).reshape(self.ENCODING_SIZE)
+            if self.__center is None:
+                with self.connection:
+                    self.__set_center(center)
+            elif not numpy.allclose(self.__center, center):
+                raise Exception("The results store is indexed around another center encoding")
+
+    ####################################################
+    # Public methods for recording detections
+    ####################################################
+
+    def append(self, source, frame, timestamp, location, label, distance=None, encoding=None):
+        """ Buffers a detection and writes the batch once it is full """
+
+        top, right, bottom, left = location
+        if encoding is not None and self.encodings:
+            encoding = numpy.asarray(encoding, dtype=numpy.float64).reshape(self.ENCODING_SIZE)
+        else:
+            encoding = None
+
+        with self.__lock:
+            self.__pending.append(((source, frame, timestamp, int(top), int(right), int(bottom), int(left), label,
+                                    None if distance is None else float(distance)), encoding))
+
+            if len(self.__pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """ Writes the buffered detections in a single transaction """
+
+        with self.__lock:
+            if not self.__pending:
+                return
+
+            with self.connection:
+                encodings = [encoding for _, encoding in self.__pending if encoding is not None]
+                if self.__center is None and encodings:
+                    self.__learn_center(encodings)
+
+                # Hash the encodings of the batch at once
+                indexed = encodings and self.__center is not None
+                buckets = iter(self.__buckets(numpy.array(encodings)) if indexed else [])
+                rows = []
+                for detection, encoding in self.__pending:
+                    if encoding is None:
+                        rows.append((*detection, *[None] * self.HASH_TABLES, None))
+                    else:
+                        rows.append((*detection, *(next(buckets) if indexed else [None] * self.HASH_TABLES),
+                                     encoding.tobytes()))
+
+                self.connection.executemany(
+                    'INSERT INTO detections (source, frame, timestamp, top, right, bottom, left, label, distance, '
+                    '%s, encoding) VALUES (%s)' % (', '.join(self.__bucket_columns),
+                                                   ', '.join('?' * (10 + self.HASH_TABLES))), rows)
+            self.__pending = []
+
+    def close(self):
+        """ Flushes the pending detections and closes the store """
+        with self.__lock:
+            self.flush()
+            self.connection.close()
+
+    ####################################################
+    # Public methods for querying detections
+    ####################################################
+
+    def appearances(self, label, source=None, start=None, end=None):
+        """ Returns the (source, frame, timestamp, location) of the detections of a label ordered by time """
+
+        self.flush()
+
+        query = 'SELECT source, frame, timestamp, top, right, bottom, left FROM detections WHERE label = ?'
+        params = [label]
+        if start is not None:
+            query += ' AND timestamp >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND timestamp <= ?'
+            params.append(end)
+        if source is not None:
+            query += ' AND source = ?'
+            params.append(source)
+        query += ' ORDER BY timestamp'
+
+        with self.__lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [(row[0], row[1], row[2], tuple(row[3:])) for row in rows]
+
+    def similar(self, query, tolerance=0.6, limit=None):
+        """ Returns the (source, frame, timestamp, location, label, distance) of the stored faces similar to
+        an image path, an image array or a face encoding, ordered by distance """
+
+        self.flush()
+
+        # Get the encoding of the first face of an image
+        if isinstance(query, str) or numpy.ndim(query) == 3:
+            image = face_recognition.load_image_file(query) if isinstance(query, str) else query
+            encodings = face_recognition.face_encodings(image)
+            if not encodings:
+                raise Exception("No face was found in the query image")
+            query = encodings[0]
+        query = numpy.asarray(query, dtype=numpy.float64)
+
+        with self.__lock:
+
+            # In every table, probe the bucket of the query and the buckets within the probe radius
+            # The buckets are integers computed here, so they are inlined rather than bound (too many for parameters)
+            # The encodings stored before the center was known have no buckets and are always compared
+            conditions = ['%s IS NULL' % self.__bucket_columns[0]]
+            if self.__center is not None:
+                conditions += ['%s IN (%s)' % (column, ', '.join(str(bucket ^ probe) for probe in self.__probes))
+                               for column, bucket in zip(self.__bucket_columns, self.__buckets(query[None])[0])]
+            rows = self.connection.execute(
+                'SELECT source, frame, timestamp, top, right, bottom, left, label, encoding FROM detections '
+                'WHERE encoding IS NOT NULL AND (%s)' % ' OR '.join(conditions)).fetchall()
+            self.candidates = len(rows)
+
+        if not rows:
+            return []
+
+        # Compare the candidates only
+        candidates = numpy.array([numpy.frombuffer(row[8], dtype=numpy.float64) for row in rows])
+        distances = face_recognition.face_distance(candidates, query)
+
+        results = [(row[0], row[1], row[2], tuple(row[3:7]), row[7], float(distance))
+                   for row, distance in zip(rows, distances) if distance <= tolerance]
+        results.sort(key=lambda result: result[5])
+        return results[:limit] if limit else results
+
+    ####################################################
+    # Utility methods
+    ####################################################
+
+    def __buckets(self, encodings):
+        """ Hashes centered encodings (one per row) into their similarity bucket of every hash table """
+        bits = numpy.dot(encodings - self.__center, self.__hyperplanes.T) > 0
+        weights = 1 << numpy.arange(self.HASH_BITS, dtype=numpy.int64)
+        return bits.reshape(len(encodings), self.HASH_TABLES, self.HASH_BITS).dot(weights).tolist()
+
+    def __learn_center(self, encodings):
+        """ Sets the center to the mean of the first encodings once there are enough of them and hashes the
+        encodings stored without buckets. Runs within a transaction """
+
+        unindexed = self.connection.execute('SELECT id, encoding FROM detections WHERE encoding IS NOT NULL AND %s '
+                                            'IS NULL' % self.__bucket_columns[0]).fetchall()
+        if len(unindexed) + len(encodings) < self.CENTER_SAMPLES:
+            return
+
+        stored = numpy.array([numpy.frombuffer(blob, dtype=numpy.float64) for _, blob in unindexed]).reshape(
+            -1, self.ENCODING_SIZE)
+        self.__set_center(numpy.vstack([stored, encodings]).mean(axis=0))
+
+        if unindexed:
+            self.connection.executemany(
+                'UPDATE detections SET %s WHERE id = ?' % ', '.join('%s = ?' % column
+                                                                    for column in self.__bucket_columns),
+                [(*buckets, row_id) for (row_id, _), buckets in zip(unindexed, self.__buckets(stored))])
+
+    def __set_center(self, center):
+        """ Stores the center of the encodings with the database. Runs within a transaction """
+        self.__center = center
+        self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('center', ?)",
+                                    (center.tobytes(),))
@@ -0,0 +1,162 @@
+# transport.py
+#
+# Shared memory frame transport between a capture process and detection worker processes
+#
+# Usage:
+#  - Instantiate a FrameRing in the capture process with the number of slots and the frame shape
+#  - Pass the FrameRing to the worker processes: as a Process argument, a Pool/ProcessPoolExecutor task argument
+#    or through a queue. It pickles as the name of its shared memory and re-attaches to it on unpickling
+#  - Capture process: descriptor = ring.put(frame) and send the small descriptor (slot, shape, timestamp, sequence)
+#    through a queue or a pipe
+#  - Worker process: frame = ring.get(descriptor), run the detections, then ring.release(descriptor)
+#  - The owner calls ring.close() then ring.unlink() when done
+#
+# Frames are copied once into a preallocated slot. Only the descriptor crosses the process boundary instead of the
+# pickled frame.
+#
+# The state of every slot lives in the same shared memory block as the frames: 0 when the slot is free, otherwise
+# the sequence number of the frame in it. get() and release() reject a descriptor whose sequence number is not the one
+# of its slot, so a double release or a late release after the slot was reused cannot free another frame.
+# Two processes releasing the same descriptor at the very same time are not told apart.
+# Slots are only acquired by put(), which must be called from a single capture process. Any process can release.
+# When all the slots are in use, put() polls for a released slot every 0.5 ms (shared memory cannot carry a
+# semaphore): a full ring adds up to 0.5 ms of latency to the capture.
+
+import time
+from multiprocessing import shared_memory
+import numpy
+
+
+class FrameRing:
+    """ Ring buffer of preallocated shared memory frame slots """
+
+    FREE = 0
+    POLL_INTERVAL = 0.0005  # Seconds between two checks for a released slot when the ring is full
+    HEADER_ALIGNMENT = 64  # The frame slots start on a cache line after the slot states
+
+    def __init__(self, slots=8, shape=(1080, 1920, 3), dtype=numpy.uint8):
+        """ Allocates the shared memory slots. Frames up to the given shape fit in a slot """
+
+        if slots < 1:
+            raise Exception("A frame ring needs at least one slot")
+
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.slot_size = int(numpy.prod(self.shape)) * self.dtype.itemsize
+
+        # Allocate a single block holding the slot states followed by all the slots
+        self.memory = shared_memory.SharedMemory(create=True, size=self.__header_size() + self.slot_size * slots)
+        self.owner = True
+        self.__attach()
+        self.__states[:] = self.FREE
+        self.__next = 0
+        self.__sequence = 0
+
+    ####################################################
+    # Public methods for frame transport
+    ####################################################
+
+    def put(self, frame, timeout=None):
+        """ Copies a frame into a free slot and returns its descriptor (slot, shape, timestamp, sequence)
+        Blocks until a slot is released unless a timeout is given """
+
+        frame = numpy.ascontiguousarray(frame, dtype=self.dtype)
+        if frame.nbytes > self.slot_size:
+            raise Exception("The frame does not fit in a frame slot")
+
+        # Wait for a free slot
+        slot, sequence = self.__acquire(timeout)
+
+        # Copy the frame into the slot
+        self.__buffer[slot, :frame.nbytes] = frame.reshape(-1).view(numpy.uint8)
+
+        return slot, frame.shape, time.time(), sequence
+
+    def get(self, descriptor):
+        """ Returns the frame of a descriptor as an array backed by the shared memory (no copy)
+        The array is only valid until the slot is released """
+
+        slot, shape, timestamp, sequence = descriptor
+        self.__check(slot, sequence)
+        size = int(numpy.prod(shape)) * self.dtype.itemsize
+        return self.__buffer[slot, :size].view(self.dtype).reshape(shape)
+
+    def release(self, descriptor):
+        """ Gives the slot of a descriptor back to the ring """
+        slot, shape, timestamp, sequence = descriptor
+        self.__check(slot, sequence)
+        self.__states[slot] = self.FREE
+
+    def free_slots(self):
+        """ Number of slots that are not in use """
+        return int(numpy.count_nonzero(self.__states == self.FREE))
+
+    def close(self):
+        """ Detaches the current process from the shared memory """
+        self.__states = None
+        self.__buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        """ Frees the shared memory. Called once by the owner after all the processes closed the ring """
+        if self.owner:
+            self.memory.unlink()
+
+    ####################################################
+    # Utility methods
+    ####################################################
+
+    def __acquire(self, timeout=None):
+        """ Marks the next free slot in ring order as in use, polling until one is released """
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            for offset in range(self.slots):
+                slot = (self.__next + offset) % self.slots
+                if self.__states[slot] == self.FREE:
+                    self.__sequence += 1
+                    self.__states[slot] = self.__sequence
+                    self.__next = (slot + 1) % self.slots
+                    return slot, self.__sequence
+
+            if deadline is not None and time.monotonic() >= deadline:
+                raise Exception("No frame slot was released in time")
+            time.sleep(self.POLL_INTERVAL)
+
+    def __check(self, slot, sequence):
+        """ Raises an exception if the slot does not hold the frame of the given sequence number """
+        if self.__states[slot] != sequence:
+            raise Exception("The frame slot was already released or holds another frame")
+
+    def __header_size(self):
+        """ Size of the slot states (one 64 bit sequence number per slot) rounded up to the alignment """
+        return -(-self.slots * 8 // self.HEADER_ALIGNMENT) * self.HEADER_ALIGNMENT
+
+    def __attach(self):
+        """ Maps the slot states and the frame slots onto the shared memory """
+        header_size = self.__header_size()
+        self.__states = numpy.ndarray((self.slots,), dtype=numpy.int64, buffer=self.memory.buf)
+        self.__buffer = numpy.ndarray((self.slots, self.slot_size), dtype=numpy.uint8, buffer=self.memory.buf,
+                                      offset=header_size)
+
+    def __getstate__(self):
+        """ Pickles the ring as the name of its shared memory so that worker processes can attach to it """
+        return {
+            'slots': self.slots,
+            'shape': self.shape,
+            'dtype': self.dtype.str,
+            'name': self.memory.name
+        }
+
+    def __setstate__(self, state):
+        """ Attaches to the shared memory of an existing ring """
+        self.slots = state['slots']
+        self.shape = state['shape']
+        self.dtype = numpy.dtype(state['dtype'])
+        self.slot_size = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.__next = 0
+        self.__sequence = 0
+        self.__attach()
@@ -0,0 +1,137 @@
+# main_concurrency_stress.py
+# Usage: %python main_concurrency_stress.py
+
+# Stress test of a single FaceEngine shared by worker threads:
+# - FaceDetect instances keep their own settings
+# - A FaceDetect instance refuses known faces that the shared engine does not hold
+# - Every concurrent detection call returns the same results as a serial call on the same image
+# - FaceDetect instances sharing the engine and running concurrently keep their own results
+# - Measures the throughput with an increasing number of threads. Whether the detections run in parallel depends on
+#   dlib releasing the GIL: without a speedup, run the detections in worker processes (see FrameRing)
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import cv2
+import face_recognition
+
+# Import the FaceDetect and FaceEngine classes
+from FaceDetect.facedetect import FaceDetect
+from FaceDetect.engine import FaceEngine
+
+
+IMAGES = ['resources/people.jpg', 'resources/person1.png', 'resources/person2.png', 'resources/person3.png']
+CALLS = 48
+PARALLEL_SPEEDUP = 1.5  # Speedup with 4 threads above which the detections are considered to run in parallel
+
+
+class HeadlessCanvas:
+    """ OpenCV canvas that does not open any window and quits right away """
+
+    def __getattr__(self, name):
+        return getattr(cv2, name)
+
+    def imshow(self, *args):
+        pass
+
+    def waitKey(self, delay):
+        return ord('q')
+
+
+class HeadlessDetector(FaceDetect):
+    """ FaceDetect that runs without displaying the results """
+
+    def __init__(self, settings=None, engine=None):
+        super().__init__(settings, engine)
+        self.canvas = HeadlessCanvas()
+
+
+def same_results(result, expected):
+    """ Compares all the fields of two FaceResults """
+    return (result.face_locations == expected.face_locations
+            and result.face_labels == expected.face_labels
+            and result.face_landmarks == expected.face_landmarks
+            and result.encoding_ages == expected.encoding_ages
+            and len(result.face_encodings) == len(expected.face_encodings)
+            and all(numpy.array_equal(encoding, expected_encoding)
+                    for encoding, expected_encoding in zip(result.face_encodings, expected.face_encodings))
+            and numpy.allclose(result.face_distances, expected.face_distances))
+
+
+if __name__ == '__main__':
+
+    # Settings are isolated between instances, from the defaults and from the dictionaries of the caller
+    features, known_faces = ['face'], {'John': 'resources/person1.png'}
+    image_detector = FaceDetect({'mode': 'image', 'face-features': features, 'known-faces': known_faces})
+    video_detector = FaceDetect()
+    features.append('chin')
+    known_faces['Jane'] = 'resources/person2.png'
+    assert image_detector.settings['mode'] == 'image' and video_detector.settings['mode'] == 'video'
+    assert image_detector.settings['face-features'] == ('face',)
+    assert set(image_detector.settings['known-faces']) == {'John'}
+
+    # Nested settings are read-only
+    try:
+        video_detector.settings['face-features'].append('chin')
+        raise AssertionError('The face-features setting can be changed')
+    except AttributeError:
+        pass
+    try:
+        image_detector.settings['known-faces']['Jim'] = 'resources/person3.png'
+        raise AssertionError('The known-faces setting can be changed')
+    except TypeError:
+        pass
+    assert FaceDetect.DEFAULT_SETTINGS['face-features'] == [] and FaceDetect.DEFAULT_SETTINGS['known-faces'] == {}
+
+    # Load the known faces once and share the engine
+    engine = FaceEngine({'John': 'resources/person1.png', 'Jane': 'resources/person2.png'})
+    images = [face_recognition.load_image_file(path) for path in IMAGES]
+
+    # Known faces that the shared engine does not hold are refused
+    try:
+        HeadlessDetector({'mode': 'image', 'method': 'recognize', 'known-faces': {'Jim': 'resources/person3.png'}},
+                         engine=engine).start(IMAGES[0])
+        raise AssertionError('Conflicting known faces were accepted')
+    except Exception as error:
+        assert 'known-faces' in str(error), error
+
+    # Reference results from serial calls
+    expected = [engine.detect(image, recognize=True) for image in images]
+
+    def work(call):
+        """ Detects one of the images and checks the results against the reference """
+        index = call % len(images)
+        result = engine.detect(images[index], recognize=True)
+        assert same_results(result, expected[index]), 'Results of concurrent calls are not isolated'
+        return index
+
+    def work_instance(call):
+        """ Runs a FaceDetect instance sharing the engine on one of the images and checks its results """
+        index = call % len(images)
+        detector = HeadlessDetector({'mode': 'image', 'method': 'recognize', 'print': False, 'draw': False},
+                                    engine=engine)
+        detector.start(IMAGES[index])
+        assert same_results(detector.result, expected[index]), 'Results of concurrent instances are not isolated'
+        assert detector.detections == expected[index].detections
+        return index
+
+    # Time the same workloads with an increasing number of threads
+    speedups = {}
+    for name, workload in (('engine calls', work), ('FaceDetect instances', work_instance)):
+        baseline = None
+        for threads in (1, 2, 4, 8):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(workload, range(CALLS)))
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            speedups[name, threads] = baseline / elapsed
+            print('%s, %d thread(s): %d calls in %.2f s (speedup x%.2f)' % (name, threads, CALLS, elapsed,
+                                                                            baseline / elapsed))
+
+    print('All concurrent results matched the serial results')
+    if speedups['engine calls', 4] >= PARALLEL_SPEEDUP:
+        print('The detections run in parallel threads (x%.2f with 4 threads)' % speedups['engine calls', 4])
+    else:
+        print('The detections do not run in parallel threads (x%.2f with 4 threads): '
+              'use worker processes for throughput' % speedups['engine calls', 4])
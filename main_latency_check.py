@@ -0,0 +1,90 @@
+# main_latency_check.py
+# Usage: %python main_latency_check.py
+
+# Checks the LatencyController against a simulated camera and a fake clock:
+# - A camera paced stream with a fast detection stays at full quality
+# - A sustained overrun degrades to the last level and drops enough frames to stay real-time
+# - The controller recovers to full quality when the load drops
+# - The frame, drop and deadline miss counters add up
+
+# Import the latency module to drive its clock
+from FaceDetect import latency
+from FaceDetect.latency import LatencyController
+
+
+class FakeClock:
+    """ Clock that only moves when the simulation says so """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+
+class FakeCamera:
+    """ Camera delivering a frame every interval. Frames queue up until they are read (or grabbed) in order,
+    and reading waits for the next frame when the queue is empty like a webcam does """
+
+    def __init__(self, clock, fps):
+        self.clock = clock
+        self.interval = 1.0 / fps
+        self.next_frame = 0
+
+    def read(self):
+        """ Waits for the next frame and returns how late it is read (the lag of the stream) """
+        arrival = self.next_frame * self.interval
+        self.clock.now = max(self.clock.now, arrival)
+        self.next_frame += 1
+        return self.clock.now - arrival
+
+
+def run(controller, camera, clock, frames, cost):
+    """ Runs the FaceDetect stream loop on the camera for a number of frames costing cost seconds each
+    Returns the processed frames that missed the budget and the lag at the end """
+
+    misses, lag = 0, 0.0
+    for _ in range(frames):
+        if controller.should_drop():
+            camera.read()
+            continue
+
+        lag = camera.read()
+        controller.start_frame()
+        clock.now += cost
+        controller.end_frame()
+        misses += cost > controller.budget
+
+    return misses, lag
+
+
+if __name__ == '__main__':
+    fake_clock = FakeClock()
+    latency.time = fake_clock
+
+    # Camera paced stream: 30 fps with a 5 ms detection never degrades
+    qos = LatencyController(target_fps=30)
+    camera = FakeCamera(fake_clock, 30)
+    run(qos, camera, fake_clock, 3000, 0.005)
+    assert qos.level == 0 and qos.deadline_misses == 0 and qos.dropped_frames == 0, qos
+    print('Camera paced:', qos)
+
+    # Sustained overrun: 10 ms budget with 35 ms frames degrades to the last level and keeps up with the camera
+    fake_clock.now = 0.0
+    qos = LatencyController(latency_budget=10)
+    camera = FakeCamera(fake_clock, 100)
+    misses, lag = run(qos, camera, fake_clock, 3000, 0.035)
+    assert qos.level == len(LatencyController.LEVELS) - 1, qos
+    assert qos.frame_skip == 4, qos.frame_skip
+    assert lag <= 0.035 + 1e-9, 'The stream lags by %.3f s' % lag
+    assert qos.frames + qos.dropped_frames == 3000 and qos.deadline_misses == misses == qos.frames, qos
+    print('Overrun:', qos, '(lag %.1f ms)' % (lag * 1000))
+
+    # Load drops: 2 ms frames recover one level at a time to full quality
+    dropped, frames = qos.dropped_frames, qos.frames
+    misses, lag = run(qos, camera, fake_clock, 3000, 0.002)
+    assert qos.level == 0 and misses == 0, qos
+    assert qos.frames - frames + qos.dropped_frames - dropped == 3000, qos
+    print('Recovered:', qos)
+
+    print('The latency controller behaved as expected')
@@ -0,0 +1,104 @@
+# main_store_recall.py
+# Usage: %python main_store_recall.py
+
+# Measures the ResultsStore similarity index against a brute force scan:
+# - Inserts background encodings, and for every query a few encodings at known distances from it
+# - Compares the faces returned by similar() with the faces within the tolerance found by scanning all of them (recall)
+# - Reports the fraction of the stored faces that the index had to compare (candidates)
+# The encodings are either spread around the origin or, like real face encodings, clustered around a mean face
+# with faces of the same person close to each other. The clustered encodings are also indexed without centering
+
+import time
+import numpy
+
+# Import the ResultsStore class
+from FaceDetect.store import ResultsStore
+
+
+ENCODINGS = 20000
+PEOPLE = 2000
+QUERIES = 50
+DISTANCES = [0.2, 0.3, 0.4, 0.5, 0.55, 0.6]
+TOLERANCE = 0.6
+
+# Clustered encodings: faces of different people are about 0.9 apart and faces of the same person about 0.4 apart
+MEAN_FACE_NORM = 0.77
+PERSON_SPREAD = 0.9 / numpy.sqrt(2 * 128)
+FACE_SPREAD = 0.4 / numpy.sqrt(2 * 128)
+
+
+def unit(vector):
+    """ Normalizes a vector """
+    return vector / numpy.linalg.norm(vector)
+
+
+def at_distance(query, distance, random):
+    """ Returns an encoding at the given euclidean distance from a query """
+    return query + distance * unit(random.randn(query.size))
+
+
+def spread_encodings(random):
+    """ Random unit encodings and queries spread around the origin """
+    encodings = [unit(random.randn(128)) for _ in range(ENCODINGS)]
+    queries = [unit(random.randn(128)) for _ in range(QUERIES)]
+    return encodings, queries
+
+
+def clustered_encodings(random):
+    """ Encodings of several faces per person around a mean face, and queries of other people """
+    mean_face = MEAN_FACE_NORM * unit(random.randn(128))
+    people = mean_face + PERSON_SPREAD * random.randn(PEOPLE, 128)
+    faces = people[random.randint(PEOPLE, size=ENCODINGS)] + FACE_SPREAD * random.randn(ENCODINGS, 128)
+    queries = mean_face + PERSON_SPREAD * random.randn(QUERIES, 128)
+    return list(faces), list(queries)
+
+
+def measure(name, encodings, queries, random, center=None):
+    """ Stores the encodings with faces at known distances of the queries and measures the index """
+
+    store = ResultsStore(':memory:', batch_size=5000, center=center)
+
+    # Faces at known distances of every query
+    encodings = list(encodings)
+    for query in queries:
+        encodings.extend(at_distance(query, distance, random) for distance in DISTANCES)
+
+    for frame, encoding in enumerate(encodings):
+        store.append('synthetic', frame, frame, (0, 0, 0, 0), 'Face', None, encoding)
+    store.flush()
+    matrix = numpy.array(encodings)
+
+    found, expected, candidates, indexed_time, scan_time = 0, 0, 0, 0.0, 0.0
+    for query in queries:
+
+        # Faces found through the index
+        start = time.perf_counter()
+        indexed = {result[1] for result in store.similar(query, tolerance=TOLERANCE)}
+        indexed_time += time.perf_counter() - start
+        candidates += store.candidates
+
+        # Faces found by scanning all the encodings
+        start = time.perf_counter()
+        scanned = set(numpy.flatnonzero(numpy.linalg.norm(matrix - query, axis=1) <= TOLERANCE).tolist())
+        scan_time += time.perf_counter() - start
+
+        found += len(indexed & scanned)
+        expected += len(scanned)
+
+    store.close()
+
+    print('%s:' % name)
+    print('  Recall at tolerance %.2f: %d / %d (%.1f%%)' % (TOLERANCE, found, expected, 100.0 * found / expected))
+    print('  Candidates compared: %.1f%% of the stored faces' % (100.0 * candidates / QUERIES / len(encodings)))
+    print('  Index query: %.2f ms, in-memory brute force scan: %.2f ms' % (indexed_time / QUERIES * 1000,
+                                                                           scan_time / QUERIES * 1000))
+    return found / expected, candidates / QUERIES / len(encodings)
+
+
+if __name__ == '__main__':
+    random = numpy.random.RandomState(0)
+
+    measure('Encodings spread around the origin', *spread_encodings(random), random)
+    clustered, queries = clustered_encodings(random)
+    measure('Clustered encodings centered on their mean', clustered, queries, random)
+    measure('Clustered encodings without centering', clustered, queries, random, center=numpy.zeros(128))
@@ -0,0 +1,83 @@
+# main_transport_benchmark.py
+# Usage: %python main_transport_benchmark.py
+
+# Compares sending 1080p BGR frames from a capture process to a worker process
+# by pickling them through a pipe against passing descriptors of a shared memory FrameRing
+
+import time
+import multiprocessing
+import numpy
+
+# Import the FrameRing class
+from FaceDetect.transport import FrameRing
+
+
+FRAMES = 300
+SHAPE = (1080, 1920, 3)
+
+
+def pickle_worker(connection):
+    """ Receives pickled frames and touches them like a detection worker would """
+    while True:
+        frame = connection.recv()
+        if frame is None:
+            return
+        connection.send(int(frame[0, 0, 0]))
+
+
+def ring_worker(ring, connection):
+    """ Receives frame descriptors, reads the frames from shared memory and releases the slots """
+    while True:
+        descriptor = connection.recv()
+        if descriptor is None:
+            ring.close()
+            return
+        frame = ring.get(descriptor)
+        pixel = int(frame[0, 0, 0])
+        ring.release(descriptor)
+        connection.send(pixel)
+
+
+def benchmark_pickle(frame):
+    """ Times frames pickled through a pipe """
+    parent, child = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=pickle_worker, args=(child,))
+    worker.start()
+
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        parent.send(frame)
+        parent.recv()
+    elapsed = time.perf_counter() - start
+
+    parent.send(None)
+    worker.join()
+    return elapsed
+
+
+def benchmark_ring(frame):
+    """ Times frames sent as shared memory descriptors """
+    ring = FrameRing(slots=4, shape=SHAPE)
+    parent, child = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=ring_worker, args=(ring, child))
+    worker.start()
+
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        parent.send(ring.put(frame))
+        parent.recv()
+    elapsed = time.perf_counter() - start
+
+    parent.send(None)
+    worker.join()
+    ring.close()
+    ring.unlink()
+    return elapsed
+
+
+if __name__ == '__main__':
+    test_frame = numpy.random.randint(0, 255, SHAPE, dtype=numpy.uint8)
+
+    for name, benchmark in (('pickle', benchmark_pickle), ('shared memory', benchmark_ring)):
+        seconds = benchmark(test_frame)
+        print('%-14s %d frames in %.2f s (%.2f ms per frame)' % (name, FRAMES, seconds, seconds / FRAMES * 1000))